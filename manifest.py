@@ -1,143 +1,303 @@
 import os
 import json
+import shutil
+import functools
 import subprocess
+import atexit
 import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from itertools import accumulate
 from datetime import datetime, timedelta
 from rich.logging import RichHandler
 from rich.console import Console
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 console = Console()
 log_dir = "logs"
 output_dir = "output"
 os.makedirs(log_dir, exist_ok=True)
 os.makedirs(output_dir, exist_ok=True)
 log_file = os.path.join(log_dir, f"manifest_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log")
+segment_cache_file = os.path.join(output_dir, ".seg_cache.json")
+# Input probing limits; assets with late-starting streams can raise them in manifest.json
+default_analyzeduration = 2000000  # microseconds
+default_probesize = 2000000  # bytes
+
+class RuleHandler(logging.Handler):
+    # Draws section_header rules on the listener thread, right before
+    # RichHandler prints the header line, so the two can't be split apart
+    def emit(self, record):
+        title = getattr(record, "rule", None)
+        if title:
+            console.rule(f"[bold cyan]{title}")
+
+# Records are formatted by the QueueHandler and written out by a background
+# listener thread, so logging from hot loops never waits on console/file I/O
+log_queue = queue.SimpleQueue()
+log_listener = QueueListener(
+    log_queue,
+    RuleHandler(),
+    RichHandler(console=console, show_time=False, show_level=True),
+    logging.FileHandler(log_file)
+)
+log_listener.start()
+atexit.register(log_listener.stop)
 
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s | %(levelname)s | %(message)s",
-    handlers=[
-        RichHandler(console=console, show_time=False, show_level=True),
-        logging.FileHandler(log_file)
-    ]
+    handlers=[QueueHandler(log_queue)]
 )
 log = logging.getLogger("manifest_logger")
 
 def section_header(title):
-    console.rule(f"[bold cyan]{title}")
-    log.info(f"====== {title.upper()} ======")
+    log.info(f"====== {title.upper()} ======", extra={"rule": title})
+
+@dataclass
+class SegList:
+    """Segments as parallel arrays of filenames and durations (seconds)."""
+    names: list = field(default_factory=list)
+    durs: array = field(default_factory=lambda: array("d"))
+
+    def append(self, name, duration):
+        self.names.append(name)
+        self.durs.append(duration)
+
+    def split(self, index):
+        return (SegList(self.names[:index], self.durs[:index]),
+                SegList(self.names[index:], self.durs[index:]))
+
+created_dirs = set()
 
 def safe_output_path(*paths):
     path = os.path.join(*paths)
-    os.makedirs(os.path.dirname(path), exist_ok=True)
+    folder = os.path.dirname(path)
+    # A bare filename lives in the working directory, which already exists
+    if folder and folder not in created_dirs:
+        os.makedirs(folder, exist_ok=True)
+        created_dirs.add(folder)
     return path
 
-def write_manifest(base_folder, base_name, segments, target_duration):
-    manifest_path = safe_output_path(base_folder, f"{base_name}.m3u8")
-    with open(manifest_path, "w") as f:
-        f.write("#EXTM3U\n#EXT-X-VERSION:3\n")
-        f.write(f"#EXT-X-TARGETDURATION:{target_duration}\n#EXT-X-MEDIA-SEQUENCE:0\n")
-        for seg in segments:
-            f.write(f"#EXTINF:{seg['duration']:.3f},\n{seg['filename']}\n")
-        f.write("#EXT-X-ENDLIST\n")
-    return manifest_path
+@functools.lru_cache(maxsize=1024)
+def format_duration(duration):
+    # Most segments share the same few durations, so reuse the formatted text
+    return f"{duration:.3f}"
 
-def ffmpeg_segment(input_file, output_pattern, segment_time):
+def ffmpeg_segment(input_file, output_pattern, segment_time, segment_list,
+                   analyzeduration=default_analyzeduration, probesize=default_probesize):
     cmd = [
-        "ffmpeg", "-y", "-i", input_file,
+        "ffmpeg", "-y", "-hide_banner", "-loglevel", "error",
+        "-analyzeduration", str(analyzeduration), "-probesize", str(probesize),
+        "-fflags", "+nobuffer", "-i", input_file,
         "-c", "copy", "-map", "0", "-f", "segment",
         "-segment_time", str(segment_time),
+        "-segment_list", segment_list,
+        "-segment_list_type", "m3u8",
         "-reset_timestamps", "1",
         output_pattern
     ]
     log.info(f"Running FFmpeg: {' '.join(cmd)}")
-    subprocess.run(cmd, check=True)
-
-def get_ts_durations(folder, prefix=""):
-    segments = []
-    for fname in sorted(os.listdir(folder)):
-        if fname.endswith(".ts"):
-            path = os.path.join(folder, fname)
-            cmd = ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "default=noprint_wrappers=1:nokey=1", path]
-            try:
-                result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-                duration = float(result.stdout.strip())
-                segments.append({"filename": f"{prefix}{fname}", "duration": duration})
-            except subprocess.CalledProcessError:
-                log.error(f"Failed ffprobe on {path}")
+    # Nothing is parsed from ffmpeg; stderr is left attached so errors still show
+    subprocess.run(cmd, check=True, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+
+def read_segment_list(segment_list, prefix=""):
+    # Pull the EXTINF durations back out of the playlist ffmpeg wrote
+    segments = SegList()
+    duration = None
+    with open(segment_list) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("#EXTINF:"):
+                duration = float(line[len("#EXTINF:"):].split(",", 1)[0])
+            elif line and not line.startswith("#") and duration is not None:
+                segments.append(f"{prefix}{line}", duration)
+                duration = None
     return segments
 
-def generate_hls_for_video(label, input_path, segment_time=6):
+def playlist_complete(segment_list):
+    # ffmpeg rewrites the list after every segment but only appends
+    # EXT-X-ENDLIST once it has finished, so a run that died partway leaves
+    # a playlist without it
+    with open(segment_list) as f:
+        return "#EXT-X-ENDLIST" in f.read()
+
+def load_json(path):
+    if orjson is not None:
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
+    with open(path) as f:
+        return json.load(f)
+
+def load_segment_cache():
+    try:
+        return load_json(segment_cache_file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def save_segment_cache(cache):
+    with open(segment_cache_file, "w") as f:
+        json.dump(cache, f, indent=2)
+
+def input_fingerprint(input_path, segment_time, analyzeduration, probesize):
+    stat = os.stat(input_path)
+    return {
+        "file_path": input_path,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "segment_time": segment_time,
+        "analyzeduration": analyzeduration,
+        "probesize": probesize
+    }
+
+def generate_hls_for_video(label, input_path, segment_time=6, cache=None,
+                           analyzeduration=default_analyzeduration, probesize=default_probesize):
     folder = os.path.join(output_dir, label)
     segment_output = os.path.join(folder, "seg%03d.ts")
+    # ffmpeg writes the per-asset playlist itself while segmenting
+    segment_list = safe_output_path(folder, f"{label}.m3u8")
+    fingerprint = input_fingerprint(input_path, segment_time, analyzeduration, probesize)
+
+    segments = None
+    if cache is not None and cache.get(label) == fingerprint and os.path.exists(segment_list):
+        segments = read_segment_list(segment_list, prefix=f"{label}/")
+        if not playlist_complete(segment_list):
+            log.warning(f"Playlist for {label} is incomplete, segmenting again")
+            segments = None
+        # Segment names are relative to output_dir once prefixed with the label
+        elif all(os.path.exists(os.path.join(output_dir, name)) for name in segments.names):
+            log.info(f"{label} unchanged since last run, reusing existing segments")
+        else:
+            log.warning(f"Segments missing for {label}, segmenting again")
+            segments = None
+
+    if segments is None:
+        section_header(f"Segmenting {label}")
+        ffmpeg_segment(input_path, segment_output, segment_time, segment_list,
+                       analyzeduration=analyzeduration, probesize=probesize)
 
-    section_header(f"Segmenting {label}")
-    ffmpeg_segment(input_path, segment_output, segment_time)
-    
-    section_header(f"Getting segment durations for {label}")
-    segments = get_ts_durations(folder, prefix=f"{label}/")
-    total_duration = sum(seg["duration"] for seg in segments)
-    target_duration = max(int(seg['duration']) + 1 for seg in segments)
-    
-    write_manifest(folder, label, segments, target_duration)
+        section_header(f"Getting segment durations for {label}")
+        segments = read_segment_list(segment_list, prefix=f"{label}/")
+    total_duration = sum(segments.durs)
+
+    if cache is not None:
+        cache[label] = fingerprint
     return label, segments, total_duration
 
 
 def write_master_manifest(master_name, entries):
     master_path = safe_output_path(output_dir, f"{master_name}.m3u8")
+    parts = ["#EXTM3U\n"]
+    parts.extend(f"#EXT-X-STREAM-INF:BANDWIDTH=500000\n{path}\n" for label, path in entries)
     with open(master_path, "w") as f:
-        f.write("#EXTM3U\n")
-        for label, path in entries:
-            f.write(f"#EXT-X-STREAM-INF:BANDWIDTH=500000\n{path}\n")
+        f.write("".join(parts))
     return master_path
 def write_timeline_manifest(output_name, stitched_segments):
     manifest_path = safe_output_path(output_dir, f"{output_name}.m3u8")
+    # Build the whole playlist in memory and hand it to the file in one write
+    parts = ["#EXTM3U\n#EXT-X-VERSION:3\n",
+             "#EXT-X-TARGETDURATION:10\n",  # conservative default
+             "#EXT-X-MEDIA-SEQUENCE:0\n"]
+    for i, part in enumerate(stitched_segments):
+        if i != 0:
+            parts.append("#EXT-X-DISCONTINUITY\n")
+        parts.extend(f"#EXTINF:{format_duration(dur)},\n{name}\n" for name, dur in zip(part.names, part.durs))
+    parts.append("#EXT-X-ENDLIST\n")
     with open(manifest_path, "w") as f:
-        f.write("#EXTM3U\n#EXT-X-VERSION:3\n")
-        f.write(f"#EXT-X-TARGETDURATION:10\n")  # conservative default
-        f.write("#EXT-X-MEDIA-SEQUENCE:0\n")
-        for i, part in enumerate(stitched_segments):
-            if i != 0:
-                f.write("#EXT-X-DISCONTINUITY\n")
-            for seg in part:
-                f.write(f"#EXTINF:{seg['duration']:.3f},\n{seg['filename']}\n")
-        f.write("#EXT-X-ENDLIST\n")
+        f.write("".join(parts))
     return manifest_path
 
+def publish(src, dst):
+    # Copy inside the kernel where copy_file_range is available; shutil
+    # covers other platforms and filesystems that refuse it
+    dst = safe_output_path(dst)
+    if hasattr(os, "copy_file_range"):
+        try:
+            with open(src, "rb") as s, open(dst, "wb") as d:
+                remaining = os.fstat(s.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(s.fileno(), d.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            if remaining == 0:
+                return dst
+        except OSError as e:
+            log.warning(f"copy_file_range failed for {src} ({e}), falling back to shutil")
+    shutil.copyfile(src, dst)
+    return dst
+
+def write_concat_output(output_name, stitched_segments):
+    # Remux the whole timeline into one continuous stream in a single ffmpeg
+    # run, so players don't reset decoders at every discontinuity
+    concat_path = safe_output_path(output_dir, f"{output_name}_concat.txt")
+    parts = []
+    for part in stitched_segments:
+        parts.extend("file '{}'\n".format(name.replace("'", "'\\''")) for name in part.names)
+    with open(concat_path, "w") as f:
+        f.write("".join(parts))
+
+    output_path = safe_output_path(output_dir, f"{output_name}.ts")
+    cmd = [
+        "ffmpeg", "-y", "-hide_banner", "-loglevel", "error",
+        "-analyzeduration", str(default_analyzeduration), "-probesize", str(default_probesize),
+        "-fflags", "+genpts",
+        "-f", "concat", "-safe", "0", "-i", concat_path,
+        "-c", "copy", output_path
+    ]
+    log.info(f"Running FFmpeg: {' '.join(cmd)}")
+    subprocess.run(cmd, check=True, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+    return output_path
+
 
 def main():
-    with open("/home/ishitasinghfaujdar/pmsltask/manifest.json") as f:
-        config = json.load(f)
+    config = load_json("/home/ishitasinghfaujdar/pmsltask/manifest.json")
 
     stitched_segments = []
+    segment_cache = load_segment_cache()
 
-    ad_segments_cache = []
-    for ad in config['ads']:
-        ad_label = ad['id']
-        ad_path = ad['file_path']
-        _, ad_segs, ad_dur = generate_hls_for_video(ad_label, ad_path)
-        ad_segments_cache.append((ad_segs, ad_dur))
+    # Each asset is segmented by its own ffmpeg process, so the threads only
+    # wait on subprocesses. Results are collected in config order, and an
+    # asset listed more than once is only segmented once.
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = {}
+        for asset in config['ads'] + config['videos']:
+            if asset['id'] not in futures:
+                futures[asset['id']] = executor.submit(
+                    generate_hls_for_video, asset['id'], asset['file_path'], cache=segment_cache,
+                    analyzeduration=asset.get('analyzeduration', default_analyzeduration),
+                    probesize=asset.get('probesize', default_probesize)
+                )
+        ad_futures = [futures[ad['id']] for ad in config['ads']]
+        show_futures = [futures[video['id']] for video in config['videos']]
 
-    ad_index = 0
-    for video in config['videos']:
-        show_label = video['id']
-        show_input = video['file_path']
-        _, show_segs, show_dur = generate_hls_for_video(show_label, show_input)
+        ad_segments_cache = []
+        for future in ad_futures:
+            _, ad_segs, ad_dur = future.result()
+            ad_segments_cache.append((ad_segs, ad_dur))
 
+        show_results = [future.result() for future in show_futures]
+
+    save_segment_cache(segment_cache)
+
+    ad_index = 0
+    for _, show_segs, show_dur in show_results:
         # Split logic: insert ad at 7 min if 13+ min remain
         split_time = 420  # 7 minutes
-        show_before_ad, show_after_ad = [], []
-        acc_time = 0
-        split_index = 0
-
-        for i, seg in enumerate(show_segs):
-            if acc_time < split_time:
-                show_before_ad.append(seg)
-                acc_time += seg["duration"]
-                split_index = i
-            else:
-                break
-        show_after_ad = show_segs[split_index + 1:]
+        # Keep segments up to and including the first one that ends at or
+        # past split_time
+        end_times = list(accumulate(show_segs.durs))
+        split_index = bisect_left(end_times, split_time)
+        show_before_ad, show_after_ad = show_segs.split(split_index + 1)
+        acc_time = end_times[len(show_before_ad.durs) - 1] if show_before_ad.durs else 0
 
         stitched_segments.append(show_before_ad)
 
@@ -156,5 +316,10 @@ def main():
     manifest_path = write_timeline_manifest("stitched_master", stitched_segments)
     log.info(f"Timeline manifest written to {manifest_path}")
 
+    if config.get("concat_output", False):
+        section_header("Remuxing stitched timeline into a single stream")
+        concat_path = write_concat_output("stitched_master", stitched_segments)
+        log.info(f"Stitched stream written to {concat_path}")
+
 if __name__ == "__main__":
     main()
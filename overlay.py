@@ -1,35 +1,91 @@
+import io
 import os
 import json
 import subprocess
+import threading
 from datetime import datetime
+import atexit
 import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
 from rich.logging import RichHandler
 from rich.console import Console
 import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Setup Logging
 console = Console()
 os.makedirs("logs", exist_ok=True)
 log_file = os.path.join("logs", f"overlay_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log")
 
+class RuleHandler(logging.Handler):
+    # Rules are printed by the listener too, otherwise they would appear
+    # ahead of log lines that are still waiting in the queue
+    def emit(self, record):
+        title = getattr(record, "rule", None)
+        if title:
+            console.rule(f"[bold cyan]{title}")
+
+# Hand records to a background thread so the ffmpeg progress drain never
+# blocks on console or file writes
+log_queue = queue.SimpleQueue()
+log_listener = QueueListener(
+    log_queue,
+    RuleHandler(),
+    RichHandler(console=console, show_time=False, show_level=True),
+    logging.FileHandler(log_file)
+)
+log_listener.start()
+atexit.register(log_listener.stop)
+
 logging.basicConfig(
     level="INFO",
     format="%(asctime)s | %(levelname)s | %(message)s",
-    handlers=[
-        RichHandler(console=console, show_time=False, show_level=True),
-        logging.FileHandler(log_file)
-    ]
+    handlers=[QueueHandler(log_queue)]
 )
 log = logging.getLogger("overlay_logger")
 
 def section_header(title: str):
-    console.rule(f"[bold cyan]{title}")
-    log.info(f"====== {title.upper()} ======")
+    log.info(f"====== {title.upper()} ======", extra={"rule": title})
+
+def load_json(path):
+    if orjson is not None:
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
+    with open(path) as f:
+        return json.load(f)
+
+def use_cuda(video_conf):
+    # overlay_cuda has no timeline support, so periodic/flash overlays, which
+    # rely on enable=, have to be blended on the CPU
+    return (video_conf.get("hwaccel") == "cuda"
+            and all(overlay["mode"] == "always" for overlay in video_conf["overlays"]))
 
 def build_filter_and_inputs(video_conf):
     base_input = ["-i", video_conf["input"]]
-    filter_parts = []
+    filter_buf = io.StringIO()
     input_cmds = []
     overlay_idx = 1
+    last_label = "0:v"
+
+    if use_cuda(video_conf):
+        # Decode into GPU memory and alpha-blend there instead of on the CPU.
+        # The decoder hands out nv12, but overlay_cuda only takes a yuva420p
+        # overlay on a yuv420p main, so convert the base on the GPU first.
+        base_input = ["-hwaccel", "cuda", "-hwaccel_output_format", "cuda"] + base_input
+        overlay_format, overlay_filter = "format=yuva420p,hwupload_cuda", "overlay_cuda"
+        filter_buf.write("[0:v]scale_cuda=format=yuv420p[base]")
+        last_label = "base"
+    else:
+        if video_conf.get("hwaccel") == "cuda":
+            log.warning(f"Timed overlays on {video_conf['input']} need the CPU overlay filter, not using CUDA.")
+        # overlay blends in yuv420 by default, so hand it yuva420p directly
+        # rather than rgba that it would convert a second time
+        overlay_format, overlay_filter = "format=yuva420p", "overlay"
 
     for overlay in video_conf["overlays"]:
         input_cmds += ["-stream_loop", "-1", "-i", overlay["graphic"]]
@@ -50,25 +106,54 @@ def build_filter_and_inputs(video_conf):
             log.warning(f"Unknown mode {mode}, skipping overlay.")
             continue
 
-        filter_parts.append(
-            f"[{overlay_idx}:v]format=rgba[ol{overlay_idx}];"
-            f"[v{overlay_idx - 1}][ol{overlay_idx}]overlay={position}{enable}[v{overlay_idx}]"
+        if filter_buf.tell():
+            filter_buf.write(";")
+        filter_buf.write(
+            f"[{overlay_idx}:v]{overlay_format}[ol{overlay_idx}];"
+            f"[{last_label}][ol{overlay_idx}]{overlay_filter}={position}{enable}[v{overlay_idx}]"
         )
+        last_label = f"v{overlay_idx}"
         overlay_idx += 1
 
-    filter_complex = ";".join(filter_parts)
-    return base_input + input_cmds, filter_complex, f"[v{overlay_idx - 1}]"
+    filter_complex = filter_buf.getvalue()
+    return base_input + input_cmds, filter_complex, f"[{last_label}]"
+
+def drain_ffmpeg_output(stream, full_output, log_interval=60):
+    # With -progress, ffmpeg emits key=value blocks terminated by a
+    # "progress=continue|end" line, interleaved with its normal log lines
+    progress = {}
+    last_log_time = 0
+    for line in stream:
+        line = line.strip()
+        key, sep, value = line.partition("=")
+        if not (sep and key.isidentifier()):
+            full_output.append(line)
+            continue
+
+        progress[key] = value
+        if key == "progress":
+            now = time.time()
+            if now - last_log_time >= log_interval or value == "end":
+                log.info(f"[ffmpeg] frame={progress.get('frame')} time={progress.get('out_time')} "
+                         f"speed={progress.get('speed')}")
+                last_log_time = now
 
 def apply_overlays(video_conf):
     section_header(f"Processing {video_conf['input']}")
     inputs, filter_complex, last_output = build_filter_and_inputs(video_conf)
     output_path = video_conf["output"]
+    # GPU frames can't go to the default software encoder
+    video_codec = ["-c:v", "h264_nvenc"] if use_cuda(video_conf) else []
     command = [
         "ffmpeg",
+        "-nostats",
+        "-progress", "pipe:2",
+        "-filter_complex_threads", str(os.cpu_count() or 1),
         *inputs,
         "-filter_complex", filter_complex,
         "-map", last_output,
         "-map", "0:a?",
+        *video_codec,
         "-c:a", "copy",
         "-shortest",
         output_path,
@@ -78,26 +163,18 @@ def apply_overlays(video_conf):
     log.info(f"Running FFmpeg for {video_conf['input']}")
     process = subprocess.Popen(
         command,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
         universal_newlines=True,
         bufsize=1
     )
-    last_log_time = 0
-    log_interval = 60 
     full_output = []
+    drain = threading.Thread(target=drain_ffmpeg_output, args=(process.stderr, full_output), daemon=True)
+    drain.start()
     try:
-        for line in process.stdout:
-            line = line.strip()
-            full_output.append(line)
-
-            if "frame=" in line:
-                now=time.time()
-                if now - last_log_time >= log_interval:
-                    log.info(f"[ffmpeg] {line}")
-                    last_log_time = now
-
         process.wait()
+        drain.join()
         if process.returncode != 0:
             logging.error("❌ FFmpeg failed with return code %s", process.returncode)
             for line in full_output:
@@ -110,8 +187,7 @@ def apply_overlays(video_conf):
 
 def main():
     section_header("OVERLAY PIPELINE STARTED")
-    with open("input/config.json", "r") as f:
-        config = json.load(f)
+    config = load_json("input/config.json")
 
     for video_conf in config["videos"]:
         apply_overlays(video_conf)